@@ -1,6 +1,7 @@
 import gradio as gr
 from uuid import uuid4 as uuid
 from pathlib import Path
+from reactagent import llm_cache
 from reactagent.environment import Environment
 from reactagent.agents.agent_research import ResearchAgent
 from reactagent.runner import create_parser
@@ -42,6 +43,8 @@ class SessionInfo:
 
         return output
 
+# one completion cache shared by all sessions of this process
+llm_cache.init_cache(str(Path('logs', 'llm_cache.sqlite')))
 session_info = SessionInfo()
 
 def predict(message, history, request: gr.Request):
@@ -41,6 +41,7 @@ class Agent(ABC):
         self.log_dir = os.path.join(args.log_dir, "agent_log")
 
         self.action_infos = env.action_infos
+        self.usage_strings = env.usage_strings
         tool_names = list(env.action_infos.keys())
         self.all_tool_names = copy.deepcopy(tool_names)
         actions_remove_from_prompt = ["Read File", "Write File", "Append File", "Retrieval from Research Log", "Append Summary to Research Log", "Python REPL", "Request Help", "Edit Script (AI)"]
@@ -207,15 +208,23 @@ class Agent(ABC):
 
     @staticmethod
     def parse_entries(s, entries):
-        """ Parse the entries from the string generated by LLM using regex."""
+        r""" Parse the entries from the string generated by LLM.
+
+        Same result as greedily matching "entry1:([\s\S]*)entry2:([\s\S]*)..." but with linear
+        substring scans instead of regex backtracking: every entry after the first is taken
+        at its last occurrence that still leaves room for the entries before it."""
         entries = [ e.strip() for e in entries]
-        pattern = ""
-        for e in entries:
-            e = e.replace("[", "\[").replace("]", "\]")
-            pattern += f"{e}:([\s\S]*)"
-        result = re.search(pattern, s, re.MULTILINE)
-        if result is None:
+        headers = [e + ":" for e in entries]
+        starts = [0] * len(headers)
+        end = len(s)
+        for idx in range(len(headers) - 1, 0, -1):
+            starts[idx] = s.rfind(headers[idx], 0, end)
+            if starts[idx] == -1:
+                raise Exception("Invalid: " + s)
+            end = starts[idx]
+        starts[0] = s.find(headers[0], 0, end)
+        if starts[0] == -1:
             raise Exception("Invalid: " + s)
 
-        parsed = [r for r in result.groups()]
-        return {e: parsed[idx]  for idx, e in enumerate(entries)}
+        ends = starts[1:] + [len(s)]
+        return {e: s[starts[idx] + len(headers[idx]):ends[idx]] for idx, e in enumerate(entries)}
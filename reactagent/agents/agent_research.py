@@ -1,11 +1,16 @@
 """ This file contains the agent class for our AI research agent."""
 import os
+import re
 import sys
 import json
+import time
+import orjson
 import anthropic
 from pathlib import Path
-from reactagent.llm import complete_text_fast, complete_text
-from reactagent.schema import Action
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from reactagent.llm import complete_text_fast, complete_text_stream, complete_multi_text_fast, evict_text_fast, cached_prompt_blocks, prompt_to_text, count_tokens, backoff_delay, MAX_API_RETRIES
+from reactagent.schema import Action, LLMError, EnhancedJSONEncoder, enhanced_json_default
 from .agent import Agent
 from .format import format_prompt_dict
 
@@ -43,13 +48,18 @@ class ResearchAgent(Agent):
         self.valid_format_entires = format_prompt_dict.keys() # use all entries by default
         if args.valid_format_entires:
             self.valid_format_entires = args.valid_format_entires
+        self._has_parse_error_pending = False # whether history_steps holds ActionInputParsingError steps
         task_desc = env.research_problem
         self.initial_prompt = initial_prompt.format(tools_prompt=self.tools_prompt, tool_names=self.prompt_tool_names,  task_description=task_desc, format_prompt="\n".join([f"{k}: {format_prompt_dict[k]}" for k in self.valid_format_entires]))
+        self.initial_prompt_tokens = count_tokens(self.initial_prompt)
 
     def run(self, env):
         feedback = ""
         Path(self.log_dir).mkdir(parents=True, exist_ok=True)
-        with Path(self.log_dir, "full_log.jsonl").open(mode='a') as full_log:
+        with Path(self.log_dir, "full_log.jsonl").open(mode='a', encoding='utf-8') as full_log, ExitStack() as stack:
+            executor = ThreadPoolExecutor(max_workers=1)
+            # do not wait for a running speculative summary on exit, e.g. when the generator is closed at the yield
+            stack.callback(executor.shutdown, wait=False, cancel_futures=True)
             while not (env.is_final() or len(self.history_steps) >= self.args.agent_max_steps):
                 last_steps = self.args.max_steps_in_context
                 last_observation_step = self.args.max_observation_steps_in_context
@@ -57,12 +67,13 @@ class ResearchAgent(Agent):
 
                 # construct prompt for LLM based on previous steps
 
-                prompt = self.initial_prompt
+                # the prompt is split into the static initial prompt, the retrieved history
+                # and the recent steps, so that the initial prompt can be cached
                 # retrieval action
                 relevant_history = env.execute(Action("Retrieval from Research Log", {"current_plan": ""}))
                 print('!! HISTORY RETRIEVED')
 
-                prompt += f"""
+                history_prompt = f"""
         Here is a summary of relevant actions and observations you have done:
         ```
         {relevant_history}
@@ -70,28 +81,58 @@ class ResearchAgent(Agent):
         Here are the 3 most recent actions actions and observations
         """
 
+                # keep the most recent observation in full, and replace older ones with their research log summary once over the token budget
+                # the actions of all steps in context and the feedback are always included
+                budget = self.args.max_prompt_tokens - self.initial_prompt_tokens - count_tokens(history_prompt) - count_tokens(str(feedback))
+                budget -= sum(self.step_tokens(self.history_steps[idx], "rendered_action") for idx in range(max(curr_step - last_steps, 0), curr_step))
+                summarized_steps = set()
+                used_tokens = 0
+                for idx in reversed(range(max(curr_step - min(last_steps, last_observation_step), 0), curr_step)):
+                    step = self.history_steps[idx]
+                    if used_tokens + self.step_tokens(step, "observation") > budget and idx != curr_step - 1 and "summary" in step:
+                        summarized_steps.add(idx)
+                        used_tokens += self.step_tokens(step, "summary")
+                    else:
+                        used_tokens += self.step_tokens(step, "observation")
+
+                recent_prompt = ""
                 for idx in range(max(curr_step - last_steps, 0), curr_step):
-                    action_string = self.print_action(self.history_steps[idx]["action"], self.valid_format_entires)
+                    action_string = self.history_steps[idx]["rendered_action"]
 
-                    prompt += f"Action:\n{action_string}\nObservation:\n"
+                    recent_prompt += f"Action:\n{action_string}\nObservation:\n"
                     if curr_step - idx > last_observation_step:
-                        prompt += "<Done>\n\n"
+                        recent_prompt += "<Done>\n\n"
+                    elif idx in summarized_steps:
+                        recent_prompt += "```\n(summarized) " + self.history_steps[idx]["summary"] + "\n```\n\n"
                     else:
                         try:
-                            prompt += "```\n" + self.history_steps[idx]["observation"] + "\n```\n\n"
+                            recent_prompt += "```\n" + self.history_steps[idx]["observation"] + "\n```\n\n"
                         except:
                             import pdb; pdb.set_trace()
 
                 # call LLM until the response is valid
-                prompt += f"\nPrevious Feedback from Human: {feedback}\n"
+                recent_prompt += f"\nPrevious Feedback from Human: {feedback}\n"
 
-                prompt += "\nNow let's start!\n\n"
+                recent_prompt += "\nNow let's start!\n\n"
 
                 entries = None
                 valid_response = False
+                format_error = ""
                 for _ in range(self.args.max_retries):
                     log_file = os.path.join(self.log_dir , f"step_{curr_step}_log.log")
-                    completion = complete_text(prompt, self.args.llm_name)
+                    # only the initial prompt is cached, the retrieved history is a fresh summary every step
+                    prompt_blocks = cached_prompt_blocks(self.initial_prompt, history_prompt, recent_prompt + format_error, n_cached=1)
+                    prompt = prompt_to_text(prompt_blocks)
+                    # API failures are retried with the same prompt and their own budget, only bad responses count against max_retries
+                    for api_attempt in range(MAX_API_RETRIES + 1):
+                        try:
+                            completion = complete_text_stream(prompt_blocks, self.args.llm_name, self.check_partial_action)
+                            break
+                        except LLMError as e:
+                            print(e, file=sys.stderr)
+                            if api_attempt == MAX_API_RETRIES:
+                                raise
+                            time.sleep(backoff_delay(api_attempt))
                     try:
                         entries = self.parse_entries(completion, self.valid_format_entires)
                         assert entries["Action"].strip() in self.all_tool_names
@@ -100,7 +141,8 @@ class ResearchAgent(Agent):
                         print("Step", curr_step, file=sys.stderr)
                         print(anthropic.AI_PROMPT + "\n" + completion + "\nObservation:\n", file=sys.stderr)
                         print("Response is invalid and discarded", file=sys.stderr)
-                        prompt += "\n\n Your response was in incorrect format. Please provide a valid response with all entries: " + ", ".join(self.valid_format_entires) + "\n\n"
+                        # the reminder is added once, not again on every retry
+                        format_error = "\n\n Your response was in incorrect format. Please provide a valid response with all entries: " + ", ".join(self.valid_format_entires) + "\n\n"
                     else:
                         break
                 if not valid_response:
@@ -135,16 +177,15 @@ class ResearchAgent(Agent):
                     observation = env.execute(Action(action, action_input))
                 else:
                     # parsing failed, give agent parsing error
-                    usage = ",\n            ".join([f"{k}: [{v}]" for k, v in self.action_infos[action].usage.items()])
-                    usage = f"""{{
-                {usage}
-        }}"""
-                    invalid_action_error = f"The action input for {action} needs to be a valid json with proper entries. You may have missed the comma between entries or used triple quotes (json does not recognizes triple quotes). Please use the correct format and try again:\n{usage}"
+                    invalid_action_error = f"The action input for {action} needs to be a valid json with proper entries. You may have missed the comma between entries or used triple quotes (json does not recognizes triple quotes). Please use the correct format and try again:\n{self.usage_strings[action]}"
 
                     observation = "ActionInputParsingError: "+ parsing_error + "\n" + invalid_action_error
 
                 print("!! OBSERVATION GENERATED")
 
+                # entries are final at this point, render the action once and reuse it
+                rendered_action = self.print_action(entries, self.valid_format_entires)
+
                 # update history_steps
 
                 full_observation = observation
@@ -154,7 +195,7 @@ class ResearchAgent(Agent):
                     log_file = os.path.join(self.log_dir , f"step_{curr_step}_summarize_observation_log.log")
 
                     print("Observation is too long. Summarizing...", file=sys.stderr)
-                    observation = self.summarize_observation(self.print_action(entries, self.valid_format_entires), observation, log_file)
+                    observation = self.summarize_observation(rendered_action, observation, log_file)
                 print("!! OBSERVATION SUMMARIZED")
 
                 info=dict(
@@ -170,40 +211,62 @@ class ResearchAgent(Agent):
                 )
 
                 print("!! FEEDBACK STAGE")
+                # feedback is usually empty, so speculatively start summarizing this step while waiting for the human
+                speculative_summary = executor.submit(
+                    self.summarize_log_entry,
+                    action=rendered_action,
+                    observation=observation,
+                    feedback="",
+                )
                 # give info to user and get feedback in return
                 feedback = (yield info)
 
-                json.dump(
-                    dict(
-                        prompt=prompt,
-                        entries=entries,
-                        full_observation=full_observation,
-                        observation=observation,
-                        feedback=feedback,
-                    ),
-                    fp=full_log,
-                    indent=2,
+                log_entry = dict(
+                    prompt=prompt,
+                    entries=entries,
+                    full_observation=full_observation,
+                    observation=observation,
+                    feedback=feedback,
                 )
-                fp.write('\n')
+                try:
+                    full_log.write(orjson.dumps(log_entry, default=enhanced_json_default, option=orjson.OPT_APPEND_NEWLINE).decode())
+                except orjson.JSONEncodeError:
+                    # orjson rejects e.g. integers beyond 64 bits parsed from the action input
+                    full_log.write(json.dumps(log_entry, cls=EnhancedJSONEncoder) + "\n")
 
                 self.history_steps.append({
                     "step_idx": len(env.trace.steps),
                     "action": entries,
+                    "rendered_action": rendered_action,
                     "observation": observation,
                     "feedback": feedback,
                 })
 
                 # filter out ActionInputParsingError if last step is not action input parsing error
-                if not observation.startswith("ActionInputParsingError"):
+                if observation.startswith("ActionInputParsingError"):
+                    self._has_parse_error_pending = True
+                elif self._has_parse_error_pending:
                     self.history_steps = [step for step in self.history_steps if not step["observation"].startswith("ActionInputParsingError")]
+                    self._has_parse_error_pending = False
 
 
                 # write to research log for retrieval
-                summary_of_last_step = "Too long to summarize."
-                for _ in range(self.args.max_retries):
+                summary_of_last_step = None
+                if not (feedback or "").strip():
+                    # prediction was right, reuse the speculative summary
+                    try:
+                        summary_of_last_step = speculative_summary.result()
+                    except Exception as e:
+                        print(e, file=sys.stderr)
+                        print("Trying again.", file=sys.stderr)
+                else:
+                    # misprediction, discard the speculative summary; if it already started it still runs to completion
+                    speculative_summary.cancel()
+
+                for _ in range(self.args.max_retries if summary_of_last_step is None else 0):
                     try:
                         summary_of_last_step = self.summarize_log_entry(
-                            action=self.print_action(self.history_steps[-1]["action"], self.valid_format_entires),
+                            action=self.history_steps[-1]["rendered_action"],
                             observation=self.history_steps[-1]["observation"],
                             feedback=self.history_steps[-1]["feedback"],
                         )
@@ -211,7 +274,11 @@ class ResearchAgent(Agent):
                     except Exception as e:
                         print(e, file=sys.stderr)
                         print("Trying again.", file=sys.stderr)
-
+                if summary_of_last_step is None:
+                    summary_of_last_step = "Too long to summarize."
+                else:
+                    # kept to stand in for the observation in later prompts
+                    self.history_steps[-1]["summary"] = summary_of_last_step
 
                 env.execute(Action(
                     name="Append Summary to Research Log",
@@ -228,13 +295,34 @@ class ResearchAgent(Agent):
 
     ################### Helper functions #####################
 
+    @staticmethod
+    def step_tokens(step, key):
+        """ Number of tokens of an entry of a history step (e.g. observation, rendered_action or summary), counted once per step """
+        if key + "_tokens" not in step:
+            step[key + "_tokens"] = count_tokens(step[key])
+        return step[key + "_tokens"]
+
+    def check_partial_action(self, completion):
+        """ Check the action of a partial completion as soon as its name is complete, so that a completion with an unknown action can be stopped and retried early.
+        Only an "Action:" line directly followed by an "Action Input:" line, after the last header of the entry before Action, is checked; anything else is left to parse_entries. """
+        entries = [e.strip() for e in self.valid_format_entires]
+        if "Action" not in entries or "Action Input" not in entries:
+            return True
+        idx = entries.index("Action")
+        start = completion.rfind(entries[idx - 1] + ":") if idx > 0 else 0
+        if start == -1:
+            return True
+        result = re.search(r"^Action:(.*)\n\s*Action Input:", completion[start:], re.MULTILINE)
+        if result is None:
+            return True
+        return result.group(1).strip() in self.all_tool_names
+
     def summarize_observation(self, action, observation, log_file, bs = 10000):
         """ Summarize the observation if it is too long with a sliding window of size bs """
 
-        bs = 10000
-        blocks = [observation[i:i+bs] for i in range(0, len(observation), bs)]
-        descriptions = []
-        for idx, b in enumerate(blocks):
+        prompts = []
+        for idx, i in enumerate(range(0, len(observation), bs)):
+            b = observation[i:i+bs]
             start_line_number = bs*idx+1
             end_line_number = bs*idx+1 + len(b)
             prompt = f"""
@@ -249,14 +337,30 @@ Summarize the observation concisely in this format:
 
 Do not include any result that is guessed rather than directly confirmed by the observation. Do not include additional information or suggestions.
 """
+            prompts.append(prompt)
+
+        # the blocks are independent, summarize them concurrently
+        descriptions = complete_multi_text_fast(prompts)
+        # merge adjacent summaries pairwise until one remains, so that every merge prompt stays small
+        while len(descriptions) > 1:
+            pairs = [descriptions[i:i+2] for i in range(0, len(descriptions), 2)]
+            merged = complete_multi_text_fast([self.merge_summaries_prompt(action, pair) for pair in pairs if len(pair) == 2])
+            if len(pairs[-1]) == 1:
+                # odd one out is carried over to the next round
+                merged.append(pairs[-1][0])
+            descriptions = merged
+        completion = descriptions[0]
+        try:
+            return completion.split("[Observation]:")[1]
+        except:
+            return completion
 
-            completion = complete_text_fast(prompt)
-            descriptions.append(completion)
-        if len(descriptions) == 1:
-            completion = descriptions[0]
-        else:
-            descriptions = "\n\n".join(["Segment {idx}: \n\n" + s for s in descriptions])
-            prompt = f"""
+    @staticmethod
+    def merge_summaries_prompt(action, descriptions):
+        """ Construct the prompt to merge summaries of consecutive segments of an observation """
+
+        descriptions = "\n\n".join([f"Segment {idx}: \n\n{s}" for idx, s in enumerate(descriptions)])
+        prompt = f"""
 {action}
 
 The full observation is too long. 
@@ -268,12 +372,7 @@ Summarize the observation concisely in this format:
 
 Do not include any result that is guessed rather than directly confirmed by the observation. Do not include additional information or suggestions.
 """
-
-            completion = complete_text_fast(prompt)
-        try:
-            return completion.split("[Observation]:")[1]
-        except:
-            return completion
+        return prompt
 
     @staticmethod
     def summarize_log_entry(action, observation, feedback, **kwargs):
@@ -297,6 +396,10 @@ Do not include any result that is guessed rather than directly confirmed by the
         Do not include any result that is guessed rather than directly confirmed by the observation. Do not include additional information or suggestions.
         """
 
-        summary = "[Reasoning]:" + complete_text_fast(prompt).split("[Reasoning]:")[1]
+        completion = complete_text_fast(prompt)
+        if "[Reasoning]:" not in completion:
+            # do not replay the malformed completion when retrying
+            evict_text_fast(prompt)
+        summary = "[Reasoning]:" + completion.split("[Reasoning]:")[1]
         return summary
     
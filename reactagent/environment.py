@@ -9,8 +9,6 @@ import subprocess
 import shutil
 import copy
 import time
-import fnmatch
-import signal
 from traceback import format_exception
 from multiprocessing import active_children
 from dacite import from_dict
@@ -21,12 +19,12 @@ from .p2m_actions import P2M_ACTIONS
 from .schema import Step, Trace, EnvException, TooLongPromptError, LLMError, EnhancedJSONEncoder 
 from .prepare_task import prepare_task, get_task_info
 
-class TimeoutException(Exception): pass
-
 class Environment:
     def __init__(self, args):
 
         self._args = args
+        if args.trace_json_every < 1:
+            raise ValueError("trace_json_every must be at least 1, got {}".format(args.trace_json_every))
         self._log_dir = os.path.join(args.log_dir, "env_log")
         self._setup_log_dir()
 
@@ -37,6 +35,17 @@ class Environment:
         self._initialize_env() # set up work dir and log dir
 
         self._action_infos =  {t.name: t for t in LOW_LEVEL_ACTIONS + HIGH_LEVEL_ACTIONS + P2M_ACTIONS}
+        # usage of each action shown in invalid action input errors
+        self._usage_strings = {}
+        for name, info in self._action_infos.items():
+            usage = ",\n            ".join([f"{k}: [{v}]" for k, v in info.usage.items()])
+            self._usage_strings[name] = f"""{{
+            {usage}
+}}"""
+
+        self._start_time = time.time()
+        # monotonic deadline checked cooperatively instead of a SIGALRM timeout
+        self._deadline = time.monotonic() + args.max_time
 
         self._static_kwargs_for_tools = {
             "device": args.device,
@@ -45,9 +54,13 @@ class Environment:
             "args": args,
             "read_only_files": self.read_only_files,
             "research_problem": self.research_problem,
+            "deadline": self.deadline,
         }
         self._trace = self._initialize_trace()
-        self._start_time = time.time()
+        # a resumed trace may already contain the final answer
+        self._final_submitted = any(s.action.name == "Final Answer" for s in self._trace.steps)
+        self._last_snapshot_folder = None
+        self._initialize_trace_log()
 
     ############################## getters ########################################
     @property
@@ -74,6 +87,10 @@ class Environment:
     def action_infos(self):
         return self._action_infos
     
+    @property
+    def usage_strings(self):
+        return self._usage_strings
+
     @property
     def args(self):
         return self._args
@@ -84,11 +101,16 @@ class Environment:
     
     @property
     def trace(self):
-        return copy.deepcopy(self._trace)
+        # not copied, as the trace grows every step; use snapshot() for an isolated copy
+        return self._trace
 
     @property
     def start_time(self):
         return self._start_time
+
+    @property
+    def deadline(self):
+        return self._deadline
     
     ############################## internal functions ########################################
     
@@ -113,23 +135,12 @@ class Environment:
 
     def _initialize_env(self):
         os.makedirs(os.path.join(self.work_dir), exist_ok=True)
-        # set up read only files
-        can_modify_files = '*'
-        size = 0
+        # set up read only files; all files can be modified for now
         self._read_only_files = []
-        for path, subdirs, files in os.walk(os.path.join(self.work_dir)):
-            relpath = os.path.relpath(path, self.work_dir)
-            # filter out the files that are read only
-            filenames = [os.path.join(relpath, filename) for filename in files]
-            for not_ignore in can_modify_files:
-                ignore_filenames = [n for n in filenames if not fnmatch.fnmatch(n, not_ignore)]
-                self.read_only_files.extend(ignore_filenames)
-            for f in files:
-                size += os.path.getsize(os.path.join(path, f))
                 
         # try save this task to a benchmark folder
         os.makedirs(os.path.join(self.log_dir), exist_ok=True)
-        if size / 1e6 < 10:
+        if not self._dir_size_exceeds(self.work_dir, 10e6):
             # save if the size is smaller than 10MB
             shutil.copytree(self.work_dir, os.path.join(self.log_dir, "env"))
         os.makedirs(os.path.join(self.log_dir, "scripts"), exist_ok=True)
@@ -151,6 +162,22 @@ class Environment:
             shutil.copytree(resume_dir, self.work_dir, symlinks=True)
 
 
+    @staticmethod
+    def _dir_size_exceeds(path, limit):
+        """ Check if the total size of the files under path exceeds limit bytes, stopping as soon as it does."""
+        size = 0
+        dirs = [path]
+        while dirs:
+            with os.scandir(dirs.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                    elif entry.is_file():
+                        size += entry.stat().st_size
+                        if size >= limit:
+                            return True
+        return False
+
     def _initialize_trace(self):
         if self.args.resume:
             print("Restoring trace from {}".format(self.args.resume))
@@ -174,12 +201,33 @@ class Environment:
         )
         return trace
     
+    def _initialize_trace_log(self):
+        # trace.jsonl gets one line per step, trace.json is only rewritten every trace_json_every steps
+        with open(os.path.join(self.log_dir, "trace.jsonl"), "w") as f:
+            for step in self._trace.steps:
+                f.write(json.dumps(step, cls=EnhancedJSONEncoder) + "\n")
+
+    def _save_trace(self):
+        with open(os.path.join(self.log_dir, f"trace.json"), "w") as f:
+            json.dump(self._trace, f, indent=4, cls=EnhancedJSONEncoder)
+
+    def _snapshot_copy_function(self, prev_folder):
+        # hardlink files unchanged since the previous snapshot instead of copying them;
+        # never link to work_dir itself, since tools overwrite its files in place
+        def copy_function(src, dst):
+            if prev_folder is not None:
+                prev = os.path.join(prev_folder, os.path.relpath(src, self.work_dir))
+                try:
+                    src_stat, prev_stat = os.stat(src), os.stat(prev)
+                    if src_stat.st_size == prev_stat.st_size and src_stat.st_mtime_ns == prev_stat.st_mtime_ns:
+                        os.link(prev, dst)
+                        return dst
+                except OSError:
+                    pass
+            return shutil.copy2(src, dst)
+        return copy_function
+
     def __enter__(self):
-        # set time out
-        def signal_handler(signum, frame):
-            raise TimeoutException("Timed out!")
-        signal.signal(signal.SIGALRM, signal_handler)
-        signal.alarm(self.args.max_time)
         return self
     
     def __exit__(self, exc_type, exc_value, traceback):  
@@ -199,6 +247,7 @@ class Environment:
         if traceback is not None:
             print("Error message saved in error.txt")
             open(os.path.join(self.log_dir, "error.txt"), "w").write(''.join(format_exception(exc_type, exc_value, traceback)))
+        self._save_trace()
         open(os.path.join(self.log_dir, "overall_time.txt"), "w").write(str(time.time() - self.start_time))
             
     ################################# public functions ########################################
@@ -206,10 +255,8 @@ class Environment:
     def is_final(self):
         """Check if the task has reached a final state, either by reaching the maximum steps or time, or because the agent has submitted a final answer. """
         
-        curr_step = len(self.trace.steps)
-        # check if any step is final answer
-        any_final_answer = any([s.action.name == "Final Answer" for s in self.trace.steps])
-        return curr_step >= self.args.max_steps or any_final_answer or time.time() - self.start_time > self.args.max_time
+        curr_step = len(self._trace.steps)
+        return curr_step >= self.args.max_steps or self._final_submitted or time.monotonic() > self.deadline
 
     def execute(self, action):
         """Execute an action and return the observation."""
@@ -233,10 +280,7 @@ class Environment:
         else:
             # execute the action and get the observation
             log_file = os.path.join(os.path.join(self.log_dir, "tool_logs") , f"step_{curr_step}_tool_log.log")
-            usage = ",\n            ".join([f"{k}: [{v}]" for k, v in self.action_infos[action_name].usage.items()])
-            usage = f"""{{
-            {usage}
-}}"""
+            usage = self.usage_strings[action_name]
             invalid_action_error = f"The action input for {action_name} needs to be a valid json with proper entries. You may have missed the comma between entries. Please use the correct format and try again:\n{usage}"
 
             if isinstance(action_input, dict):
@@ -253,8 +297,6 @@ class Environment:
                     print(e, file=sys.stderr)
                     print(action_input, file=sys.stderr)
                     observation = "EnvError: " + invalid_action_error
-                except TimeoutException as e:
-                    raise e
                 except Exception as e:
                     # should not happen
                     print("Step: ", curr_step, file=sys.stderr)
@@ -269,21 +311,31 @@ class Environment:
         step_time = time.time()
 
         trace.steps.append(Step(action, observation, step_time))
+        if action_name == "Final Answer":
+            self._final_submitted = True
 
         self.save(curr_step)
         return observation
 
+    def snapshot(self):
+        """ Return a deep copy of the trace, for consumers that need it isolated from later steps """
+        return copy.deepcopy(self._trace)
+
     def save(self, curr_step):
         """ Save the trace and snapshot of the workspace folder """     
-        with open(os.path.join(self.log_dir, f"trace.json"), "w") as f:
-            json.dump(self.trace, f, indent=4, cls=EnhancedJSONEncoder)
+        if isinstance(curr_step, int):
+            with open(os.path.join(self.log_dir, "trace.jsonl"), "a") as f:
+                f.write(json.dumps(self._trace.steps[-1], cls=EnhancedJSONEncoder) + "\n")
+        if not isinstance(curr_step, int) or (curr_step + 1) % self.args.trace_json_every == 0 or self.is_final():
+            self._save_trace()
 
         ##### save a snapshot of the current step
         save_folder = os.path.join(self.log_dir, "traces", f"step_{curr_step}_files")
         if os.path.exists(save_folder):
             shutil.rmtree(save_folder)
 
-        shutil.copytree(self.work_dir, save_folder, symlinks=True)
+        shutil.copytree(self.work_dir, save_folder, symlinks=True, copy_function=self._snapshot_copy_function(self._last_snapshot_folder))
+        self._last_snapshot_folder = save_folder
 
     ############## for logging convenience ##############
 
@@ -2,12 +2,16 @@
 
 from pathlib import Path
 from .schema import TooLongPromptError, LLMError
+from . import llm_cache
 from functools import partial
 from transformers import AutoTokenizer
 import transformers
 import torch
 import os
 import time
+import random
+import asyncio
+import tiktoken
 
 
 # try:
@@ -17,17 +21,19 @@ import time
 #     print(e)
 #     print("Could not load hugging face token HF_TOKEN from environ")
 
+REQUEST_TIMEOUT = 10 * 60 # seconds before an API request is abandoned
+
 try:
     import anthropic
     # setup anthropic API key
-    anthropic_client = anthropic.Anthropic(api_key=os.environ['CLAUDE_API_KEY'])
+    anthropic_client = anthropic.Anthropic(api_key=os.environ['CLAUDE_API_KEY'], timeout=REQUEST_TIMEOUT)
 except Exception as e:
     print(e)
     print("Could not load anthropic API key CLAUDE_API_KEY from environ")
 
 try:
     import openai
-    openai_client = openai.OpenAI()
+    openai_client = openai.OpenAI(timeout=REQUEST_TIMEOUT)
 except Exception as e:
     print(e)
     print("Could not load OpenAI API key OPENAI_API_KEY from environ")
@@ -84,8 +90,34 @@ class LlamaAgent:
 
 agent_cache = {}
 
+# approximate token counts for prompt budgeting, the encoding is loaded on first use
+token_encoding = None
+def count_tokens(text):
+    """ Count the tokens of a text with the cl100k_base tokenizer; for Claude models this is an estimate."""
+    global token_encoding
+    if token_encoding is None:
+        token_encoding = tiktoken.get_encoding("cl100k_base")
+    return len(token_encoding.encode(text, disallowed_special=()))
+
+def prompt_to_text(prompt):
+    """ Flatten a prompt given as a list of content blocks into a single string."""
+    if isinstance(prompt, str):
+        return prompt
+    return "".join(block["text"] for block in prompt)
+
+def cached_prompt_blocks(*texts, n_cached=0):
+    """ Build Anthropic content blocks from prompt segments, marking the first n_cached segments as cacheable prefixes."""
+    blocks = []
+    for idx, text in enumerate(texts):
+        block = {"type": "text", "text": text}
+        if idx < n_cached:
+            block["cache_control"] = {"type": "ephemeral"}
+        blocks.append(block)
+    return blocks
+
 def complete_text_openai(prompt, stop_sequences=[], model="gpt-3.5-turbo", max_tokens_to_sample=2000, temperature=0.2):
     """ Call the OpenAI API to complete a prompt."""
+    prompt = prompt_to_text(prompt)
     raw_request = {
           "model": model,
           "temperature": temperature,
@@ -98,7 +130,7 @@ def complete_text_openai(prompt, stop_sequences=[], model="gpt-3.5-turbo", max_t
     return completion
 
 def complete_text_claude(prompt, stop_sequences=[anthropic.HUMAN_PROMPT], model="claude-v1", max_tokens_to_sample=2000, temperature=0.5):
-    """ Call the Claude API to complete a prompt."""
+    """ Call the Claude API to complete a prompt. The prompt can be a string or a list of content blocks (e.g. with cache_control markers)."""
 
     ai_prompt = anthropic.AI_PROMPT
     try:
@@ -135,6 +167,75 @@ def complete_text_claude(prompt, stop_sequences=[anthropic.HUMAN_PROMPT], model=
 
     return completion
 
+MAX_API_RETRIES = 20 # retries of transient API errors for a single completion, separate from format retries
+def backoff_delay(attempt):
+    """ Exponential backoff with jitter before retry number attempt (from 0), capped at 30 seconds."""
+    return min(2 ** attempt * 0.5 + random.random(), 30)
+
+TRANSIENT_ERROR_TYPES = ["rate_limit_error", "overloaded_error", "api_error"]
+def is_transient_status_error(e):
+    """ Check if an API status error is worth retrying, by its status code or by the error type in its body
+    (errors sent within a stream carry the original 200 response)."""
+    if e.status_code == 429 or e.status_code >= 500:
+        return True
+    try:
+        return e.body["error"]["type"] in TRANSIENT_ERROR_TYPES
+    except (KeyError, TypeError):
+        return False
+
+def complete_text_claude_stream(prompt, on_text, stop_sequences=[anthropic.HUMAN_PROMPT], model="claude-v1", max_tokens_to_sample=2000, temperature=0.5):
+    """ Stream a Claude completion, calling on_text with the text so far after each chunk. The stream is stopped early if on_text returns False.
+    Rate limit, overload and server errors, and any error after the stream has started, are raised as LLMError so that the caller can retry with backoff."""
+    started = False
+    try:
+        completion = ""
+        with anthropic_client.messages.stream(
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt,
+                }
+            ],
+            model=model,
+            stop_sequences=stop_sequences,
+            temperature=temperature,
+            max_tokens=max_tokens_to_sample,
+        ) as stream:
+            started = True
+            for text in stream.text_stream:
+                completion += text
+                if on_text(completion) is False:
+                    break
+    except anthropic.APIStatusError as e:
+        if started or is_transient_status_error(e):
+            raise LLMError(e)
+        print(e)
+        raise TooLongPromptError()
+    except Exception as e:
+        raise LLMError(e)
+
+    return completion
+
+def complete_text_stream(
+    prompt, model: str, on_text,
+    max_tokens_to_sample=2000,
+    temperature=0.5,
+    top_p=None,
+) -> str:
+    """ Complete text, calling on_text with the partial completion as it is generated. Only Claude models are streamed, other models call on_text once with the full completion."""
+    if model.startswith("claude"):
+        return complete_text_claude_stream(
+            prompt,
+            on_text,
+            stop_sequences=[anthropic.HUMAN_PROMPT, "Observation:"],
+            temperature=temperature,
+            model=model,
+            max_tokens_to_sample=max_tokens_to_sample,
+        )
+    completion = complete_text(prompt, model, max_tokens_to_sample=max_tokens_to_sample, temperature=temperature, top_p=top_p)
+    on_text(completion)
+    return completion
+
 def complete_multi_text(
     prompts: str, model: str,
     max_tokens_to_sample=None,
@@ -174,7 +275,7 @@ def complete_multi_text(
         completions = []
         try:
             completions = agent_cache[model].complete_text(
-                prompts=prompts,
+                prompts=[prompt_to_text(p) for p in prompts],
                 num_responses=responses_per_request,
                 max_gen_len=max_tokens_to_sample,
                 temperature=temperature,
@@ -182,7 +283,7 @@ def complete_multi_text(
             )
             for _ in range(responses_per_request):
                 completions += agent_cache[model].complete_text(
-                    prompts=prompts,
+                    prompts=[prompt_to_text(p) for p in prompts],
                 )
         except Exception as e:
             raise LLMError(e)
@@ -208,4 +309,89 @@ def complete_text(
 # specify fast models for summarization etc
 FAST_MODEL = "claude-3-haiku"
 def complete_text_fast(prompt, *args, **kwargs):
-    return complete_text(prompt, model=FAST_MODEL, *args, **kwargs)
+    key = llm_cache.LLMCache.make_key(FAST_MODEL, prompt, *args, **kwargs)
+    completion = llm_cache.get(key)
+    if completion is None:
+        completion = complete_text(prompt, model=FAST_MODEL, *args, **kwargs)
+        llm_cache.put(key, completion)
+    return completion
+
+def evict_text_fast(prompt, *args, **kwargs):
+    """ Drop the cached fast model completion for a prompt, e.g. when it could not be parsed."""
+    llm_cache.evict(llm_cache.LLMCache.make_key(FAST_MODEL, prompt, *args, **kwargs))
+
+
+MAX_CONCURRENCY = 8 # max number of in-flight requests for concurrent completions
+async def acomplete_text_claude(client, prompt, stop_sequences=[anthropic.HUMAN_PROMPT], model="claude-v1", max_tokens_to_sample=2000, temperature=0.5, max_retries=5):
+    """ Call the Claude API asynchronously. Like complete_text_claude, transient errors are retried without limit, here with exponential backoff;
+    a response without content is retried up to max_retries times before returning an empty completion."""
+    api_failures = 0
+    for _ in range(max_retries):
+        while True:
+            try:
+                message = await client.messages.create(
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt,
+                        }
+                    ],
+                    model=model,
+                    stop_sequences=stop_sequences,
+                    temperature=temperature,
+                    max_tokens=max_tokens_to_sample,
+                )
+                break
+            except anthropic.APIConnectionError as e:
+                print(e)
+            except anthropic.APIStatusError as e:
+                print(e)
+                if not is_transient_status_error(e):
+                    raise TooLongPromptError()
+            except Exception as e:
+                raise LLMError(e)
+            await asyncio.sleep(backoff_delay(api_failures))
+            api_failures += 1
+        if message.content:
+            return message.content[0].text
+        # e.g. a stop sequence matched right away
+        print("empty completion, retrying")
+    return ""
+
+async def acomplete_text_fast(prompt, client=None, **kwargs):
+    """ Complete text with the fast model without blocking the event loop."""
+    if client is not None and FAST_MODEL.startswith("claude"):
+        key = llm_cache.LLMCache.make_key(FAST_MODEL, prompt, **kwargs)
+        completion = llm_cache.get(key)
+        if completion is None:
+            completion = await acomplete_text_claude(
+                client,
+                prompt,
+                stop_sequences=[anthropic.HUMAN_PROMPT, "Observation:"],
+                model=FAST_MODEL,
+                **kwargs,
+            )
+            llm_cache.put(key, completion)
+        return completion
+    # other models have no async client, run them in a worker thread
+    return await asyncio.to_thread(complete_text_fast, prompt, **kwargs)
+
+def complete_multi_text_fast(prompts, max_concurrency=MAX_CONCURRENCY, **kwargs):
+    """ Complete independent prompts concurrently with the fast model, keeping the order of prompts."""
+    async def run_all():
+        semaphore = asyncio.Semaphore(max_concurrency)
+        client = None
+        if FAST_MODEL.startswith("claude"):
+            client = anthropic.AsyncAnthropic(api_key=os.environ['CLAUDE_API_KEY'], timeout=REQUEST_TIMEOUT)
+
+        async def run_one(prompt):
+            async with semaphore:
+                return await acomplete_text_fast(prompt, client=client, **kwargs)
+
+        try:
+            return await asyncio.gather(*[run_one(prompt) for prompt in prompts])
+        finally:
+            if client is not None:
+                await client.close()
+
+    return list(asyncio.run(run_all()))
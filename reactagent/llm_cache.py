@@ -0,0 +1,83 @@
+""" This file contains an exact-match cache for LLM completions, persisted to sqlite. """
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class LLMCache:
+    """ LRU cache of completions keyed on the sha256 of the model, prompt and sampling arguments. """
+
+    def __init__(self, path, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # completions are requested from worker threads as well
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, completion TEXT, last_used REAL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        self._conn.commit()
+        self._size = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(model, prompt, *args, **kwargs):
+        raw = json.dumps([model, prompt, args, kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT completion FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            # committed with the next put or on close
+            self._conn.execute("UPDATE cache SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key, completion):
+        with self._lock:
+            updated = self._conn.execute("UPDATE cache SET completion = ?, last_used = ? WHERE key = ?", (completion, time.time(), key)).rowcount
+            if not updated:
+                self._conn.execute("INSERT INTO cache VALUES (?, ?, ?)", (key, completion, time.time()))
+                self._size += 1
+            if self._size > self.max_entries:
+                # drop the least recently used entries
+                self._conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY last_used LIMIT ?)", (self._size - self.max_entries,))
+                self._size = self.max_entries
+            self._conn.commit()
+
+    def evict(self, key):
+        with self._lock:
+            self._size -= self._conn.execute("DELETE FROM cache WHERE key = ?", (key,)).rowcount
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+# one cache per process, disabled until init_cache is called by the entry point
+llm_cache = None
+
+def init_cache(path, max_entries=10000):
+    """ Enable the completion cache, stored in the sqlite file at path. Calling it again reuses the open cache. """
+    global llm_cache
+    if llm_cache is None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        llm_cache = LLMCache(path, max_entries=max_entries)
+    return llm_cache
+
+def get(key):
+    if llm_cache is None:
+        return None
+    return llm_cache.get(key)
+
+def put(key, completion):
+    if llm_cache is not None:
+        llm_cache.put(key, completion)
+
+def evict(key):
+    if llm_cache is not None:
+        llm_cache.evict(key)
@@ -3,6 +3,7 @@
 import os
 import subprocess
 import selectors
+import signal
 import shutil
 import glob
 import sys
@@ -178,7 +179,8 @@ def execute_script(script_name, work_dir = ".", **kwargs):
         device = kwargs["device"]
         python = kwargs["python"]
         cmd = f"CUDA_VISIBLE_DEVICES={device} {python} -u {script_path}"
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True, cwd=work_dir)
+        # own process group, so that the script and not only the shell can be killed at the deadline
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True, cwd=work_dir, start_new_session=True)
 
         stdout_lines = []
         stderr_lines = []
@@ -187,7 +189,16 @@ def execute_script(script_name, work_dir = ".", **kwargs):
         selector.register(process.stdout, selectors.EVENT_READ)
         selector.register(process.stderr, selectors.EVENT_READ)
 
+        deadline = kwargs.get("deadline")
+        timed_out = False
         while process.poll() is None and selector.get_map():
+            if deadline is not None and time.monotonic() > deadline:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+                process.stdout.close()
+                process.stderr.close()
+                timed_out = True
+                break
             events = selector.select(timeout=1)
 
             for key, _ in events:
@@ -199,6 +210,10 @@ def execute_script(script_name, work_dir = ".", **kwargs):
                     print("STDERR:", line, end =" ")
                     stderr_lines.append(line)
 
+        if timed_out:
+            observation = "".join(stdout_lines) + "".join(stderr_lines)
+            return "The script was stopped because the maximum time was reached. Here is the output so far:\n" + observation
+
         for line in process.stdout:
             line = line
             print("STDOUT:", line, end =" ")
@@ -1,15 +1,18 @@
 """ 
 This file is the entry point for MLAgentBench.
 """
+import os
 import argparse
 from dotenv import load_dotenv
 load_dotenv()
-from reactagent import llm
+from reactagent import llm, llm_cache
 from reactagent.environment import Environment
 from reactagent.agents.agent_research import ResearchAgent
 from reactagent.users.console_user import ConsoleUser
 
 def run(args):
+    # reuse fast model completions across retries and recurring observations
+    llm_cache.init_cache(os.path.join(args.log_dir, "llm_cache.sqlite"))
     with Environment(args) as env:
 
         print("=====================================")
@@ -38,6 +41,7 @@ def create_parser() -> argparse.ArgumentParser:
     parser.add_argument("--python", type=str, default="python3", help="python command")
     parser.add_argument("--resume", type=str, default=None, help="resume from a previous run")
     parser.add_argument("--resume-step", type=int, default=0, help="the step to resume from")
+    parser.add_argument("--trace-json-every", type=int, default=10, help="rewrite the full trace.json every K steps (K >= 1); every step is appended to trace.jsonl and the workspace is snapshotted every step")
 
     # general agent configs
     parser.add_argument("--llm-name", type=str, help="llm name")
@@ -52,6 +56,7 @@ def create_parser() -> argparse.ArgumentParser:
     parser.add_argument("--valid-format-entires", type=str, nargs='+', default=None, help="valid format entries")
     parser.add_argument("--max-steps-in-context", type=int, default=3, help="max steps in context")
     parser.add_argument("--max-observation-steps-in-context", type=int, default=3, help="max observation steps in context")
+    parser.add_argument("--max-prompt-tokens", type=int, default=16000, help="token budget of the prompt; older observations in context are replaced by their summaries beyond it")
     parser.add_argument("--max-retries", type=int, default=5, help="max retries")
 
     return parser
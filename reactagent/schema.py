@@ -4,17 +4,23 @@ from argparse import Namespace
 import json
 from typing import Any, Dict, List
 
+def enhanced_json_default(o):
+    """ Serialize the objects handled by EnhancedJSONEncoder, for use as the default of orjson.dumps """
+    #if it is a function, use its string name
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+    elif hasattr(o, '__call__'):
+        return o.__name__
+    elif isinstance(o, Namespace):
+        return vars(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
 class EnhancedJSONEncoder(json.JSONEncoder):
     def default(self, o):
-        #if it is a function, use its string name
-        if dataclasses.is_dataclass(o):
-            return dataclasses.asdict(o)
-        elif hasattr(o, '__call__'):
-            return o.__name__
-        elif isinstance(o, Namespace):
-            return vars(o)
-
-        return super().default(o)
+        try:
+            return enhanced_json_default(o)
+        except TypeError:
+            return super().default(o)
 
 class TooLongPromptError(Exception):
     pass